@@ -0,0 +1,53 @@
+# cython: language_level=3
+"""Optional compiled accelerator for the inline-rendering hot path.
+
+Build in place with:  cythonize -i _inline.pyx
+
+core.inline_render falls back to its pure-Python implementation when this
+extension has not been built, so the build scripts never require Cython.
+The semantics here must stay identical to that fallback: one scan that
+expands {{link:id}} references, passes anchors through verbatim, wraps
+code/bold/italic spans, and escapes everything else.
+"""
+import re
+
+import core
+
+_ESC_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;",
+})
+
+_INLINE_ALL_RE = re.compile(
+    r"(?P<anchor><a\b[^>]*>.*?</a>)"
+    r"|\{\{link:(?P<link>[a-zA-Z0-9_\-]+)\}\}"
+    r"|`(?P<code>[^`]+)`"
+    r"|\*\*(?P<bold>[^*]+)\*\*"
+    r"|(?<!\*)\*(?P<em>[^*]+)\*(?!\*)"
+)
+
+
+cpdef str inline_render(str text, dict resources):
+    cdef list parts = []
+    cdef Py_ssize_t pos = 0
+    cdef str kind
+
+    for m in _INLINE_ALL_RE.finditer(text):
+        parts.append(text[pos:m.start()].translate(_ESC_TABLE))
+        kind = m.lastgroup
+        if kind == "anchor":
+            parts.append(m.group())
+        elif kind == "link":
+            parts.append(core.inline_link(m.group("link"), resources))
+        elif kind == "code":
+            parts.append("<code>" + m.group("code").translate(_ESC_TABLE) + "</code>")
+        elif kind == "bold":
+            parts.append("<strong>" + m.group("bold").translate(_ESC_TABLE) + "</strong>")
+        else:
+            parts.append("<em>" + m.group("em").translate(_ESC_TABLE) + "</em>")
+        pos = m.end()
+    parts.append(text[pos:].translate(_ESC_TABLE))
+    return "".join(parts)
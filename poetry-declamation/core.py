@@ -0,0 +1,581 @@
+"""Shared parsing and rendering code for the poetry-declamation builds.
+
+Both build.py and build_v3.py import from here; they only differ in which
+source/template/output paths they wire up.
+"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from pathlib import Path
+import hashlib
+import io
+import re
+
+# html.escape is pure Python (up to five str.replace passes per call); a
+# single C-level translate produces identical text in one pass.
+_ESC_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;",
+})
+
+def esc(s: str) -> str:
+    return s.translate(_ESC_TABLE)
+
+class _LazyRe:
+    """Defer re.compile until a pattern is first used.
+
+    Importing this module for a subset of its functions (say, a
+    parse_bookmarks-only dry run) then never pays for compiling the other
+    patterns. The first attribute access compiles and caches the bound
+    pattern methods on the instance, so subsequent calls are plain
+    attribute lookups with no __getattr__ involvement.
+    """
+
+    def __init__(self, pattern: str, flags: int = 0):
+        self._pattern = pattern
+        self._flags = flags
+
+    def __getattr__(self, name: str):
+        compiled = re.compile(self._pattern, self._flags)
+        for attr in ("match", "fullmatch", "search", "sub", "split", "finditer"):
+            self.__dict__[attr] = getattr(compiled, attr)
+        return getattr(compiled, name)
+
+# Declared once at import, compiled on first use; these run on every line
+# of the source.
+_BOOKMARK_RE = _LazyRe(r"^@(video|link)\s+([a-zA-Z0-9_\-]+)\s*$")
+_BOOKMARK_PREFIX_RE = _LazyRe(r"^@(video|link)\s+")
+_KV_RE = _LazyRe(r"^(label|url|desc)\s*:\s*(.+)\s*$")
+_YT_RE = _LazyRe(r"youtu\.be/(?P<short>[^?&/]+)|youtube\.com/watch\?v=(?P<watch>[^?&/]+)")
+_LINK_REF_RE = _LazyRe(r"\{\{link:([a-zA-Z0-9_\-]+)\}\}")
+_INLINE_RE = _LazyRe(
+    r"(?P<anchor><a\b[^>]*>.*?</a>)"
+    r"|`(?P<code>[^`]+)`"
+    r"|\*\*(?P<bold>[^*]+)\*\*"
+    r"|(?<!\*)\*(?P<em>[^*]+)\*(?!\*)"
+)
+_INLINE_ALL_RE = _LazyRe(
+    r"(?P<anchor><a\b[^>]*>.*?</a>)"
+    r"|\{\{link:(?P<link>[a-zA-Z0-9_\-]+)\}\}"
+    r"|`(?P<code>[^`]+)`"
+    r"|\*\*(?P<bold>[^*]+)\*\*"
+    r"|(?<!\*)\*(?P<em>[^*]+)\*(?!\*)"
+)
+_URL_RE = _LazyRe(r"(https?://[^\s)]+)")
+_FENCE_RE = _LazyRe(r"^```video\s+([a-zA-Z0-9_\-]+)\s*$")
+_FENCE_KEY_RE = _LazyRe(r"^(task|watch|after)\s*:\s*(.*)$")
+_FENCE_ITEM_RE = _LazyRe(r"^\s*-\s+(.*)$")
+_RID_RE = _LazyRe(r"[a-zA-Z0-9_\-]+")
+_TITLE_RE = _LazyRe(r"^#\s+(.+)$", re.MULTILINE)
+_TPL_PLACEHOLDER_RE = _LazyRe(r"\{\{(TITLE|CONTENT)\}\}")
+
+def parse_bookmarks(lines: list[str]) -> dict[str, dict[str, str]]:
+    resources: dict[str, dict[str, str]] = {}
+    i = 0
+    while i < len(lines):
+        line = lines[i].rstrip()
+        # Only lines starting with '@' can open a bookmark; skip the regex
+        # for everything else (the vast majority of the source).
+        if not line.startswith("@"):
+            i += 1
+            continue
+        m = _BOOKMARK_RE.match(line)
+        if not m:
+            i += 1
+            continue
+        rtype, rid = m.group(1), m.group(2)
+        item = {"type": rtype, "label": "", "url": "", "desc": ""}
+        i += 1
+        while i < len(lines):
+            nxt = lines[i].rstrip()
+            if nxt.startswith("@") and _BOOKMARK_PREFIX_RE.match(nxt):
+                break
+            if ":" in nxt and (kv := _KV_RE.match(nxt)):
+                item[kv.group(1)] = kv.group(2).strip()
+            i += 1
+        # Extract the YouTube id once here rather than on every render.
+        # {{video:id}} may point at any bookmark with a url, so do not
+        # restrict this to type == "video".
+        vid = ""
+        if item["url"]:
+            m = _YT_RE.search(item["url"])
+            if m:
+                vid = m.group("short") or m.group("watch")
+        item["vid"] = vid
+        # Pre-escape the fields the renderers need so repeated renders of
+        # the same bookmark never re-run the escape.
+        item["safe_url"] = esc(item["url"])
+        item["safe_label"] = esc(item["label"].strip())
+        item["safe_desc"] = esc(item["desc"].strip())
+        thumb_html = ""
+        if vid:
+            thumb = f"https://i.ytimg.com/vi/{vid}/hqdefault.jpg"
+            thumb_html = (
+                f"<a class='video-thumb' href=\"{item['safe_url']}\" target=\"_blank\" rel=\"noreferrer\">"
+                f"<img alt='Video thumbnail' src=\"{esc(thumb)}\"></a>"
+            )
+        item["thumb_html"] = thumb_html
+        resources[rid] = item
+    return resources
+
+def video_block(rid: str, resources: dict[str, dict[str, str]]) -> str:
+    item = resources.get(rid)
+    if not item or not item.get("url"):
+        return (
+            "<div class='video'>"
+            "<div class='video-top'>"
+            "<div class='video-title'><span class='tag'>Video</span> Missing bookmark: "
+            f"<code>{esc(rid)}</code></div>"
+            "</div></div>"
+        )
+
+    # The block is a pure function of the bookmark; render it at most once.
+    if (cached := item.get("_block_html")) is not None:
+        return cached
+
+    safe_url = item["safe_url"]
+    safe_label = item["safe_label"] or "Video"
+    safe_desc = item["safe_desc"]
+    thumb_html = item["thumb_html"]
+
+    top = []
+    top.append("<div class='video-top'>")
+    top.append(thumb_html)
+    top.append(
+        f"<div class='video-title'><span class='tag'>Video</span> "
+        f"<a href=\"{safe_url}\" target=\"_blank\" rel=\"noreferrer\"><strong>{safe_label}</strong></a></div>"
+    )
+    if safe_desc:
+        top.append(f"<p class='video-desc'>{safe_desc}</p>")
+    top.append("</div>")  # video-top
+
+    bottom = (
+        "<div class='video-bottom'>"
+        f"<p class='video-open'><a href=\"{safe_url}\" target=\"_blank\" rel=\"noreferrer\">Open on YouTube</a></p>"
+        "</div>"
+    )
+
+    result = "<div class='video'>" + "".join(top) + bottom + "</div>"
+    item["_block_html"] = result
+    return result
+
+def local_prompts_block(prompts: dict[str, object], resources: dict[str, dict[str, str]]) -> str:
+    sections: list[str] = []
+
+    task = (prompts.get("task") or "").strip()
+    if task:
+        task_html = inline_render(task, resources)
+        sections.append(
+            "<div class='prompt-section'>"
+            "<div class='prompt-title'>Task</div>"
+            f"<p>{task_html}</p>"
+            "</div>"
+        )
+
+    watch = prompts.get("watch") or []
+    if isinstance(watch, list) and watch:
+        items = []
+        for item in watch:
+            txt = inline_render(str(item), resources)
+            items.append(f"<li>{txt}</li>")
+        sections.append(
+            "<div class='prompt-section'>"
+            "<div class='prompt-title'>Watch for</div>"
+            f"<ul>{''.join(items)}</ul>"
+            "</div>"
+        )
+
+    after = prompts.get("after") or []
+    if isinstance(after, list) and after:
+        items = []
+        for item in after:
+            txt = inline_render(str(item), resources)
+            items.append(f"<li>{txt}</li>")
+        sections.append(
+            "<div class='prompt-section'>"
+            "<div class='prompt-title'>After watching</div>"
+            f"<ul>{''.join(items)}</ul>"
+            "</div>"
+        )
+
+    if not sections:
+        return ""
+
+    return (
+        "<div class='local-prompts'>"
+        "<div class='local-prompts-title'>Local prompts</div>"
+        + "".join(sections)
+        + "</div>"
+    )
+
+def inline_link(rid: str, resources: dict[str, dict[str, str]]) -> str:
+    item = resources.get(rid)
+    if not item or not item.get("url"):
+        return f"<code>Missing:{esc(rid)}</code>"
+    if (cached := item.get("_inline_html")) is not None:
+        return cached
+    safe_url = item["safe_url"]
+    safe_label = item["safe_label"] or "Link"
+    # Keep inline links compact: label only.
+    result = f"<a href=\"{safe_url}\" target=\"_blank\" rel=\"noreferrer\">{safe_label}</a>"
+    item["_inline_html"] = result
+    return result
+
+def expand_inline_refs(text: str, resources: dict[str, dict[str, str]]) -> str:
+    # Replace {{link:id}} inline (keeps list formatting)
+    def sub(m: re.Match) -> str:
+        rid = m.group(1)
+        return inline_link(rid, resources)
+    return _LINK_REF_RE.sub(sub, text)
+
+def inline_format(text: str) -> str:
+    """
+    Minimal inline markdown:
+    - **bold**
+    - *italic*
+    - `code`
+    This runs AFTER we have injected safe HTML anchors for inline links.
+    One finditer sweep: anchors pass through verbatim, everything between
+    matches is escaped, so no placeholder protect/restore step is needed.
+    """
+    buf: list[str] = []
+    pos = 0
+    for m in _INLINE_RE.finditer(text):
+        buf.append(esc(text[pos:m.start()]))
+        kind = m.lastgroup
+        if kind == "anchor":
+            buf.append(m.group())
+        elif kind == "code":
+            buf.append(f"<code>{esc(m.group('code'))}</code>")
+        elif kind == "bold":
+            buf.append(f"<strong>{esc(m.group('bold'))}</strong>")
+        else:
+            buf.append(f"<em>{esc(m.group('em'))}</em>")
+        pos = m.end()
+    buf.append(esc(text[pos:]))
+    return "".join(buf)
+
+def inline_render(text: str, resources: dict[str, dict[str, str]]) -> str:
+    """Expand {{link:id}} refs and apply inline formatting in one pass.
+
+    One finditer over the combined alternation replaces the former
+    expand-then-format pair of full-string scans; link anchors are emitted
+    directly and never re-escaped.
+
+    This is the pure-Python path; when the optional compiled extension is
+    present (cythonize -i _inline.pyx) it replaces this function below.
+    """
+    parts: list[str] = []
+    pos = 0
+    for m in _INLINE_ALL_RE.finditer(text):
+        parts.append(esc(text[pos:m.start()]))
+        kind = m.lastgroup
+        if kind == "anchor":
+            parts.append(m.group())
+        elif kind == "link":
+            parts.append(inline_link(m.group("link"), resources))
+        elif kind == "code":
+            parts.append(f"<code>{esc(m.group('code'))}</code>")
+        elif kind == "bold":
+            parts.append(f"<strong>{esc(m.group('bold'))}</strong>")
+        else:
+            parts.append(f"<em>{esc(m.group('em'))}</em>")
+        pos = m.end()
+    parts.append(esc(text[pos:]))
+    return "".join(parts)
+
+try:
+    from _inline import inline_render  # noqa: F811 - optional accelerator
+except ImportError:
+    pass
+
+def linkify_raw_urls(s: str) -> str:
+    # Convert raw URLs that remain in text into links.
+    def repl(m):
+        u = m.group(1)
+        safe = esc(u)
+        return f'<a href="{safe}" target="_blank" rel="noreferrer">{safe}</a>'
+    return _URL_RE.sub(repl, s)
+
+# Below this many top-level blocks the thread-pool handoff costs more than
+# it saves; render inline instead.
+_PARALLEL_MIN_BLOCKS = 64
+
+def _classify_colon(s: str) -> tuple[str, object]:
+    if s == ":::teacher":
+        return ("teacher_open", None)
+    if s == ":::":
+        return ("teacher_close", None)
+    return ("p", s)
+
+def _classify_fence(s: str) -> tuple[str, object]:
+    m = _FENCE_RE.match(s)
+    if m:
+        return ("fence_open", m.group(1))
+    return ("p", s)
+
+def _classify_video(s: str) -> tuple[str, object]:
+    # Video blocks should stand alone on a line
+    if s.startswith("{{video:") and s.endswith("}}") and _RID_RE.fullmatch(s[8:-2]):
+        return ("video", s[8:-2])
+    return ("p", s)
+
+def _classify_heading(s: str) -> tuple[str, object]:
+    # headings (#..####)
+    level = 1
+    while level < 4 and level < len(s) and s[level] == "#":
+        level += 1
+    if level < len(s) and s[level].isspace():
+        return ("heading", (level, s[level + 1:].strip()))
+    return ("p", s)
+
+def _classify_bq(s: str) -> tuple[str, object]:
+    return ("bq", s[1:].lstrip())
+
+def _classify_ol(s: str) -> tuple[str, object]:
+    k = 1
+    while k < len(s) and s[k].isdigit():
+        k += 1
+    if k + 1 < len(s) and s[k] == "." and s[k + 1].isspace():
+        return ("ol", s[k + 2:].strip())
+    return ("p", s)
+
+def _classify_ul(s: str) -> tuple[str, object]:
+    if len(s) > 1 and s[1].isspace():
+        return ("ul", s[2:].strip())
+    return ("p", s)
+
+# Prefix table mapping a line's first character to the one classifier that
+# can match it — the table-driven equivalent of running every line pattern
+# in a single multi-pattern automaton. Lines starting with any other
+# character are paragraphs without further inspection.
+_CLASSIFIERS = {
+    ":": _classify_colon,
+    "`": _classify_fence,
+    "{": _classify_video,
+    "#": _classify_heading,
+    ">": _classify_bq,
+    "-": _classify_ul,
+    "*": _classify_ul,
+}
+for _d in "0123456789":
+    _CLASSIFIERS[_d] = _classify_ol
+
+def _parse_fence_body(lines: list[str], i: int, n: int) -> tuple[dict[str, object], int]:
+    """Collect task/watch/after prompts until the closing fence.
+
+    Returns the prompts plus the index of the first line after the fence.
+    """
+    prompts: dict[str, object] = {"task": "", "watch": [], "after": []}
+    current: str | None = None
+    while i < n:
+        raw = lines[i]
+        if raw.strip().startswith("```"):
+            i += 1
+            break
+        line_in = raw.rstrip()
+        mkey = _FENCE_KEY_RE.match(line_in.strip())
+        if mkey:
+            key = mkey.group(1)
+            rest = mkey.group(2).strip()
+            current = key
+            if key == "task":
+                prompts["task"] = rest
+            else:
+                if rest:
+                    cast_list = prompts[key]
+                    if isinstance(cast_list, list):
+                        cast_list.append(rest)
+            i += 1
+            continue
+
+        if current in ("watch", "after"):
+            mitem = _FENCE_ITEM_RE.match(line_in)
+            if mitem:
+                cast_list = prompts[current]
+                if isinstance(cast_list, list):
+                    cast_list.append(mitem.group(1).strip())
+                i += 1
+                continue
+
+        if current == "task" and line_in.strip():
+            task = (prompts.get("task") or "").strip()
+            joiner = " " if task else ""
+            prompts["task"] = f"{task}{joiner}{line_in.strip()}"
+
+        i += 1
+    return prompts, i
+
+def _split_blocks(lines: list[str]) -> list[tuple[str, object]]:
+    """First pass: partition the source into independent top-level blocks.
+
+    Sequential and cheap — one table lookup plus one classifier per line,
+    tracking only run/teacher state. All inline rendering happens per block
+    in _render_block, so the blocks can be rendered in any order (or
+    concurrently).
+    """
+    blocks: list[tuple[str, object]] = []
+    in_teacher = False
+
+    # Current open run of consecutive bq/ol/ul lines, if any.
+    run_kind: str | None = None
+    run_items: list[str] = []
+
+    def flush_run():
+        nonlocal run_kind, run_items
+        if run_kind is not None:
+            blocks.append((run_kind, run_items))
+            run_kind = None
+            run_items = []
+
+    classifiers = _CLASSIFIERS
+    i = 0
+    n = len(lines)
+    while i < n:
+        s = lines[i].strip()
+        i += 1
+
+        if not s:
+            flush_run()
+            continue
+
+        classifier = classifiers.get(s[0])
+        kind, payload = classifier(s) if classifier else ("p", s)
+
+        if kind in ("bq", "ol", "ul"):
+            if run_kind != kind:
+                flush_run()
+                run_kind = kind
+            run_items.append(payload)
+            continue
+
+        flush_run()
+
+        if kind == "p":
+            blocks.append(("p", payload))
+        elif kind == "heading" or kind == "video":
+            blocks.append((kind, payload))
+        elif kind == "fence_open":
+            prompts, i = _parse_fence_body(lines, i, n)
+            blocks.append(("fence", (payload, prompts)))
+        elif kind == "teacher_open":
+            if not in_teacher:
+                blocks.append(("html", '<div class="teacher-only">'))
+                in_teacher = True
+        elif kind == "teacher_close":
+            if in_teacher:
+                blocks.append(("html", "</div>"))
+                in_teacher = False
+
+    flush_run()
+    if in_teacher:
+        blocks.append(("html", "</div>"))
+
+    return blocks
+
+def _render_block(block: tuple[str, object], resources: dict[str, dict[str, str]]) -> str:
+    kind, payload = block
+
+    if kind == "p":
+        return f"<p>{inline_render(payload, resources)}</p>"
+
+    if kind == "html":
+        return payload
+
+    if kind == "heading":
+        level, title = payload
+        cls = "" if level != 1 else " class=\"doc-title\""
+        return f"<h{level}{cls}>{esc(title)}</h{level}>"
+
+    if kind == "bq":
+        inner = "\n".join(
+            f"<p>{inline_render(t, resources)}</p>" for t in payload
+        )
+        return f"<blockquote>\n{inner}\n</blockquote>"
+
+    if kind in ("ol", "ul"):
+        inner = "\n".join(
+            f"<li>{inline_render(t, resources)}</li>" for t in payload
+        )
+        return f"<{kind}>\n{inner}\n</{kind}>"
+
+    if kind == "video":
+        return video_block(payload, resources)
+
+    # fence
+    rid, prompts = payload
+    return (
+        "<div class='video-stack'>"
+        + video_block(rid, resources)
+        + local_prompts_block(prompts, resources)
+        + "</div>"
+    )
+
+def _write_html(lines: list[str], resources: dict[str, dict[str, str]], write) -> None:
+    blocks = _split_blocks(lines)
+
+    if len(blocks) >= _PARALLEL_MIN_BLOCKS:
+        # Blocks are independent once split, so long documents can render
+        # them concurrently; order is preserved by executor.map.
+        with ThreadPoolExecutor() as pool:
+            rendered = pool.map(_render_block, blocks, repeat(resources))
+    else:
+        rendered = (_render_block(b, resources) for b in blocks)
+
+    first = True
+    for part in rendered:
+        if first:
+            first = False
+        else:
+            write("\n")
+        write(part)
+
+def md_to_html(lines: list[str], resources: dict[str, dict[str, str]]) -> str:
+    # C-implemented StringIO keeps per-fragment overhead and peak memory
+    # below the grow-a-list-then-join pattern on long documents.
+    buf = io.StringIO()
+    _write_html(lines, resources, buf.write)
+    return buf.getvalue()
+
+def build(source: Path, template: Path, output: Path) -> None:
+    src_bytes = source.read_bytes()
+    tpl_bytes = template.read_bytes()
+
+    # Skip the whole parse/render when neither input changed since the last
+    # build. A content hash in a sidecar stamp is sturdier than mtimes
+    # (editors and git checkouts both lie about those).
+    digest = hashlib.sha256(src_bytes + b"\0" + tpl_bytes).hexdigest()
+    stamp = output.with_name(output.name + ".stamp")
+    if output.exists() and stamp.exists() and stamp.read_text(encoding="utf-8").strip() == digest:
+        print(f"{output.name} up-to-date")
+        return
+
+    md = src_bytes.decode("utf-8", errors="replace")
+    # Split once; parse_bookmarks and the renderer share the same list
+    # (splitlines has already dropped the line terminators).
+    lines = md.splitlines()
+    resources = parse_bookmarks(lines)
+
+    title = "Poetry declamation"
+    m = _TITLE_RE.search(md)
+    if m:
+        title = m.group(1).strip()
+
+    tpl = tpl_bytes.decode("utf-8")
+    # Split the template around its placeholders once, then stream: the
+    # rendered content goes straight to the file block by block instead of
+    # being assembled into a document-sized string first.
+    segments = _TPL_PLACEHOLDER_RE.split(tpl)
+    with output.open("w", encoding="utf-8") as f:
+        for idx, seg in enumerate(segments):
+            if idx % 2 == 0:
+                f.write(seg)
+            elif seg == "CONTENT":
+                _write_html(lines, resources, f.write)
+            else:  # TITLE
+                f.write(esc(title))
+    stamp.write_text(digest, encoding="utf-8")
+    print(f"Wrote {output.name}")